@@ -1,175 +1,316 @@
 import array
 import micropython
+import struct
 import watch
 
+from micropython import const
+
+# Fractional bits of the fixed point filter coefficients. Q15 would
+# leave no room for coefficients beyond +/-1 so, just like the postShift
+# in CMSIS' Q15 biquads, we give up one bit of precision for headroom.
+_QBITS = const(14)
+
+# Layout of the header that starts each record in hrs.data: a 0xffff
+# re-sync marker, format version, flags, the time (year, month, day,
+# hour, minute, second), the sensor offset and the number of (signed
+# 16-bit, offset relative) samples that follow. The offset is the first
+# raw sample of the record and bit 0 of the flags is set if any sample
+# had to be clipped to fit.
+_DEBUG_HDR = "<HBB6HIH"
+_DEBUG_VERSION = const(2)
+_DEBUG_CLIPPED = const(1)
+
 @micropython.viper
-def _compare(d1, d2, count: int, shift: int) -> int:
-    """Compare two sequences of (signed) bytes and quantify how dissimilar
-    they are.
+def _trough(d, length: int, lo: int, hi: int) -> int:
+    """Find the first trough in how dissimilar a sequence of (signed)
+    bytes is from itself when shifted by lo to hi samples.
+
+    Expanding the sum of squared differences for a shift k gives
+    Eh(k) + Et(k) - 2 * R(k), where Eh and Et are the energy of the
+    overlapping head and tail of the sequence and R is the cross term.
+    Moving from k to k + 1 removes one sample from each energy so only
+    R(k) needs a full pass over the data.
+
+    Flipping the top bit of each byte biases it into the 0..255 range.
+    The bias cancels out in each difference so the result is unchanged
+    but we need no sign extension.
     """
-    p1 = ptr8(d1)
-    p2 = ptr8(d2)
-
-    e = 0
-    for i in range(count):
-        s1 = int(p1[i])
-        if s1 > 127:
-            s1 -= 256
-
-        s2 = int(p2[i])
-        if s2 > 127:
-            s2 -= 256
-
-        d = s1 - s2
-        e += d * d
-    return e
-
-class Biquad:
-    """Direct Form II Biquad Filter"""
-
-    def __init__(self, b0, b1, b2, a1, a2):
-        self._coeff = (b0, b1, b2, a1, a2)
-        self._v1 = 0
-        self._v2 = 0
-
-    def step(self, x):
-        c = self._coeff
-        v1 = self._v1
-        v2 = self._v2
-
-        v = x - (c[3] * v1) - (c[4] * v2)
-        y = (c[0] * v) + (c[1] * v1) + (c[2] * v2)
-
-        self._v2 = v1
-        self._v1 = v
-        return y
-
-
-class PTAGC:
-    """Peak Tracking Automatic Gain Control
-    In order for the correlation checks to work correctly we must
-    aggressively reject spikes caused by fast DC steps. Setting a
-    threshold based on the median is very effective at killing
-    spikes but needs an extra 1k for sample storage which isn't
-    really plausible for a microcontroller.
+    p = ptr8(d)
+
+    # Shifting by length or more leaves nothing to compare (and would
+    # read outside the buffer)
+    if hi >= length:
+        hi = length - 1
+
+    # Energy of d[k:] and d[:length - k] for k = lo - 2
+    k = lo - 2
+    eh = 0
+    et = 0
+    for j in range(length):
+        s = int(p[j]) ^ 0x80
+        if j >= k:
+            eh += s * s
+        if j < length - k:
+            et += s * s
+
+    z2 = 0
+    z1 = 0
+    while k <= hi:
+        n = length - k
+        r = 0
+
+        # The cross term is unrolled by eight with a plain loop to pick
+        # up the remainder
+        n8 = (n >> 3) << 3
+        for j in range(0, n8, 8):
+            i = j + k
+            r += (int(p[i]) ^ 0x80) * (int(p[j]) ^ 0x80)
+            r += (int(p[i + 1]) ^ 0x80) * (int(p[j + 1]) ^ 0x80)
+            r += (int(p[i + 2]) ^ 0x80) * (int(p[j + 2]) ^ 0x80)
+            r += (int(p[i + 3]) ^ 0x80) * (int(p[j + 3]) ^ 0x80)
+            r += (int(p[i + 4]) ^ 0x80) * (int(p[j + 4]) ^ 0x80)
+            r += (int(p[i + 5]) ^ 0x80) * (int(p[j + 5]) ^ 0x80)
+            r += (int(p[i + 6]) ^ 0x80) * (int(p[j + 6]) ^ 0x80)
+            r += (int(p[i + 7]) ^ 0x80) * (int(p[j + 7]) ^ 0x80)
+        for j in range(n8, n):
+            r += (int(p[j + k]) ^ 0x80) * (int(p[j]) ^ 0x80)
+        z = eh + et - (r << 1)
+
+        if k >= lo:
+            if z2 > z1 and z1 < z:
+                return k
+        z2 = z1
+        z1 = z
+
+        s = int(p[k]) ^ 0x80
+        eh -= s * s
+        s = int(p[n - 1]) ^ 0x80
+        et -= s * s
+        k += 1
+
+    return -1
+
+@micropython.native
+def _pipeline(state, spl):
+    """Preprocessing stage used by PPG.preprocess().
+
+    The sample passes through a high-pass filter, a peak tracking
+    automatic gain control and a low-pass filter. Both filters are
+    Transposed Direct Form II biquads. Everything is inlined into one
+    function to avoid per-stage method dispatch and runs in fixed point
+    (Q4 samples, _QBITS coefficients and a Q8 peak for the AGC). The
+    state lives in an array("i") laid out as
+    ``[hpf_s1, hpf_s2, lpf_s1, lpf_s2, agc_peak, dc]``.
     """
-
-    def __init__(self, start, decay, threshold):
-        self._peak = start
-        self._decay = decay
-        self._boost = 1 / decay
-        self._threshold = threshold
-
-    def step(self, spl):
-        # peak tracking
-        peak = self._peak
-        if abs(spl) > peak:
-            peak *= self._boost
+    # The HPF state grows with the distance between the input and dc so
+    # we track the DC level to keep every intermediate value a small int.
+    # b1 is rounded to exactly -2 * b0 so the HPF rejects DC completely,
+    # which means moving dc by c and removing the steady state response
+    # to c (-b0 * c, b2 * c) from the filter state leaves the output
+    # unchanged.
+    x = spl - state[5]
+    if x > 256 or x < -256:
+        state[5] = spl
+        if x > 512 or x < -512:
+            # A step this big gets rejected by the AGC anyway so just
+            # restart the filter
+            state[0] = 0
+            state[1] = 0
         else:
-            peak *= self._decay
-        self._peak = peak
-
-        # rejection filter (clipper)
-        threshold = self._threshold
-        if spl > (peak * threshold) or spl < (peak * -threshold):
-            return 0
-
-        # booster
-        spl = 100 * spl / (2 * peak)
-        return spl
+            x <<= 4
+            state[0] += 14259 * x
+            state[1] -= 14259 * x
+        x = 0
+
+    # High-pass filter: b = (0.87033078, -1.74066156, 0.87033078),
+    #                   a = (-1.72377617, 0.75754694)
+    x <<= 4
+    spl = ((14259 * x) + state[0] + (1 << (_QBITS - 1))) >> _QBITS
+    state[0] = (-28518 * x) + (28242 * spl) + state[1]
+    state[1] = (14259 * x) - (12412 * spl)
+
+    # Peak tracking automatic gain control (start 20, decay 0.971,
+    # threshold 2). In order for the correlation checks to work
+    # correctly we must aggressively reject spikes caused by fast DC
+    # steps. Setting a threshold based on the median is very effective
+    # at killing spikes but needs an extra 1k for sample storage which
+    # isn't really plausible for a microcontroller.
+    peak = state[4]
+    a = abs(spl) << 4
+    if a > peak:
+        # Round up so that even a tiny peak can recover
+        peak += ((peak * 1957) >> 16) + 1
+    else:
+        peak -= (peak * 1900) >> 16
+    state[4] = peak
+    if a > (peak << 1):
+        x = 0
+    else:
+        x = (12800 * spl) // peak
+
+    # Low-pass filter: b = (0.11595249, 0.23190498, 0.11595249),
+    #                  a = (-0.72168143, 0.18549138)
+    spl = ((1900 * x) + state[2] + (1 << (_QBITS - 1))) >> _QBITS
+    state[2] = (3800 * x) + (11824 * spl) + state[3]
+    state[3] = (1900 * x) - (3039 * spl)
+
+    # Back to an integer, saturated so that it always fits in a byte
+    spl = (spl + 8) >> 4
+    if spl > 127:
+        return 127
+    if spl < -128:
+        return -128
+    return spl
 
 class PPG:
     def __init__(self, spl):
         self._offset = spl
-        self.data = array.array("b")
+        self._flags = 0
+        self.data = bytearray(240)
+        self._n = 0
         self.debug = None
 
-        self._hpf = Biquad(0.87033078, -1.74066156, 0.87033078, -1.72377617, 0.75754694)
-        self._agc = PTAGC(20, 0.971, 2)
-        self._lpf = Biquad(0.11595249, 0.23190498, 0.11595249, -0.72168143, 0.18549138)
+        # First trough found by the previous successful measurement
+        self._last_trough = None
+
+        # enable_debug() swaps in a variant that also logs the raw samples
+        self.preprocess = self._preprocess_nodebug
 
-    def preprocess(self, spl):
+        # Filter state for _pipeline()
+        self._state = array.array("i", (0, 0, 0, 0, 20 << 8, spl))
+
+    @micropython.native
+    def _preprocess_nodebug(self, spl):
         """Preprocess a PPG sample.
         Must be called at 24Hz for accurate heart rate calculations.
         """
-        if self.debug != None:
-            self.debug.append(spl)
-        spl -= self._offset
-        spl = self._hpf.step(spl)
-        spl = self._agc.step(spl)
-        spl = self._lpf.step(spl)
-        spl = int(spl)
-
-        self.data.append(spl)
+        spl = _pipeline(self._state, spl)
+
+        # Samples are stored as two's complement bytes (_trough() takes
+        # care of the sign)
+        n = self._n
+        if n < len(self.data):
+            self.data[n] = spl & 0xff
+            self._n = n + 1
         return spl
 
-    def _get_heart_rate(self):
-        def compare(d, shift):
-            return _compare(d[shift:], d[:-shift], len(d) - shift, shift)
-
-        def trough(d, mn, mx):
-            z2 = compare(d, mn - 2)
-            z1 = compare(d, mn - 1)
-            for i in range(mn, mx + 1):
-                z = compare(d, i)
-                if z2 > z1 and z1 < z:
-                    return i
-                z2 = z1
-                z1 = z
+    @micropython.native
+    def _preprocess_debug(self, spl):
+        """Preprocess a PPG sample and log the raw value."""
+        n = self._n
+        if n == 0:
+            self._offset = spl
+            self._flags = 0
+        if n < len(self.debug):
+            d = spl - self._offset
+            if d > 32767:
+                d = 32767
+                self._flags |= _DEBUG_CLIPPED
+            elif d < -32768:
+                d = -32768
+                self._flags |= _DEBUG_CLIPPED
+            self.debug[n] = d
+        return self._preprocess_nodebug(spl)
+
+    def __len__(self):
+        return self._n
 
-            return -1
-
-        data = memoryview(self.data)
-
-        # Search initially from ~210 to 30 bpm
-        t0 = trough(data, 7, 48)
+    def _get_heart_rate(self):
+        # _trough() is told the length explicitly so there is no need to
+        # slice the (partially filled) buffer
+        data = self.data
+        length = self._n
+
+        # Heart rate doesn't change much between measurements so start by
+        # searching close to the previous trough... The narrowed search
+        # and the check below cost about 20 lags so this only pays off
+        # when the full sweep would need more than that (<= 60 bpm).
+        t0 = -1
+        last = self._last_trough
+        if last != None and last >= 24:
+            t0 = _trough(data, length, max(7, last - 4), min(48, last + 4))
+
+            # The window skips the short lags so if the heart rate has
+            # doubled we would lock on to the second cycle. Make sure
+            # there isn't a trough at half the lag before trusting it.
+            if t0 >= 0:
+                h = t0 // 2
+                if _trough(data, length, max(7, h - 3), h + 3) >= 0:
+                    self._last_trough = None
+                    t0 = -1
+
+        # ... otherwise search from ~210 to 30 bpm
+        if t0 < 0:
+            t0 = _trough(data, length, 7, 48)
         if t0 < 0:
             return None
 
         # Check the second cycle ...
         t1 = t0 * 2
-        t1 = trough(data, t1 - 5, t1 + 5)
+        t1 = _trough(data, length, t1 - 5, t1 + 5)
         if t1 < 0:
             return None
 
         # ... and the third
         t2 = (t1 * 3) // 2
-        t2 = trough(data, t2 - 5, t2 + 4)
+        t2 = _trough(data, length, t2 - 5, t2 + 4)
         if t2 < 0:
             return None
 
         # If we can find a fourth cycle then use that for the extra
         # precision otherwise report whatever we've found
         t3 = (t2 * 4) // 3
-        t3 = trough(data, t3 - 4, t3 + 4)
+        t3 = _trough(data, length, t3 - 4, t3 + 4)
+        self._last_trough = t0
         if t3 < 0:
             return (60 * 24 * 3) // t2
         return (60 * 24 * 4) // t3
 
     def get_heart_rate(self):
-        if len(self.data) < 200:
+        if self._n < 200:
             return None
 
         hr = self._get_heart_rate()
-
-        # Clear out the accumulated data
-        self.data = array.array("b")
+        if hr == None:
+            self._last_trough = None
 
         # Dump the debug data
-        if self.debug:
-            with open("hrs.data", "ab") as f:
-                # Re-sync marker
-                f.write(b"\xff\xff")
-                now = watch.rtc.get_localtime()
-                f.write(array.array("H", now[:6]))
-                f.write(self.debug)
-            self.debug = array.array("H")
+        if self.debug != None:
+            now = watch.rtc.get_localtime()
+            hdr = self._debug_hdr
+            struct.pack_into(_DEBUG_HDR, hdr, 0, 0xffff, _DEBUG_VERSION,
+                             self._flags,
+                             now[0], now[1], now[2], now[3], now[4], now[5],
+                             self._offset, self._n)
+            f = self._debug_file
+            f.write(hdr)
+            f.write(memoryview(self.debug)[:self._n])
+
+        # Clear out the accumulated data
+        self._n = 0
 
         return hr
 
     def enable_debug(self):
         if self.debug == None:
-            self.debug = array.array("H")
+            self.debug = array.array("h", (0,) * len(self.data))
+            self._debug_hdr = bytearray(struct.calcsize(_DEBUG_HDR))
+
+            # Keep the log open while we run to avoid the filesystem
+            # syncing metadata for every record (see close())
+            self._debug_file = open("hrs.data", "ab")
+
+            # The debug samples share the write index with the data so
+            # restart the measurement to avoid logging a partial record
+            self._n = 0
+            self.preprocess = self._preprocess_debug
+
+    def close(self):
+        """Flush and close the debug log (if there is one)."""
+        if self.debug != None:
+            self._debug_file.close()
+            self.debug = None
+            self.preprocess = self._preprocess_nodebug
 
 
 """Heart rate monitor
@@ -196,6 +337,29 @@ import wasp
 import machine
 # import ppg
 
+@micropython.viper
+def _graph_column(buf, spl: int, color: int):
+    """Render one sample of the graph into a raw RGB565 strip.
+
+    The strip is two pixels wide and covers rows 32 to 239. The left
+    column is the bar (with the bottom spl rows drawn in color) and the
+    right column is always black, clearing the graph ahead of us.
+    """
+    p = ptr8(buf)
+    hi = color >> 8
+    lo = color & 0xff
+    edge = 207 - spl
+
+    # The bottom row is left black (just like the right column)
+    for y in range(207):
+        i = y << 2
+        if y < edge:
+            p[i] = 0
+            p[i + 1] = 0
+        else:
+            p[i] = hi
+            p[i + 1] = lo
+
 class HeartApp:
     """Heart rate monitor application."""
 
@@ -204,6 +368,7 @@ class HeartApp:
     def __init__(self):
         self._debug = False
         self._hrdata = None
+        self._phase = 0
 
     def foreground(self):
         """Activate the application."""
@@ -222,20 +387,29 @@ class HeartApp:
         if self._debug:
             self._hrdata.enable_debug()
         self._x = 0
+        self._col = bytearray(2 * 208 * 2)
+        self._timer = machine.Timer(id=1, period=41666,
+                                    mode=machine.Timer.PERIODIC,
+                                    callback=self._wake)
 
     def background(self):
         wasp.watch.hrs.disable()
+        self._timer.stop()
+        self._timer = None
+        self._hrdata.close()
         self._hrdata = None
+        self._col = None
 
+    @micropython.native
     def _subtick(self, ticks):
         """Notify the application that its periodic tick is due."""
         draw = wasp.watch.drawable
 
         spl = self._hrdata.preprocess(wasp.watch.hrs.read_hrs())
-        if len(self._hrdata.data) >= 240:
+        if len(self._hrdata) >= 240:
             draw.string("{}HR".format(wasp.watch.hrs.read_hrs()), 0, 6, width=80)
 
-        if len(self._hrdata.data) >= 240:
+        if len(self._hrdata) >= 240:
             draw.set_color(wasp.system.theme("bright"))
             draw.string("           ", 0, 6, width=240)
             draw.string("{} bpm".format(self._hrdata.get_heart_rate()), 80, 6, width=80)
@@ -251,12 +425,10 @@ class HeartApp:
         spl += 104
 
         x = self._x
-        draw.fill(0, x, 32, 1, 208 - spl)
-        draw.fill(color, x, 239 - spl, 1, spl)
+        _graph_column(self._col, spl, color)
+        wasp.watch.display.rawblit(self._col, x, 32, 2, 208)
         if x % 10 == 0:
             draw.string("{}".format(spl), 160, 6, width=80)
-        if x < 238:
-            draw.fill(0, x + 1, 32, 2, 208)
         x += 2
         if x >= 240:
             x = 0
@@ -266,22 +438,28 @@ class HeartApp:
         """This is an outrageous hack but, at present, the RTC can only
         wake us up every 125ms so we implement sub-ticks using a regular
         timer to ensure we can read the sensor at 24Hz.
+
+        The timer interrupt also wakes the CPU so we can idle (rather
+        than spin) between the sub-ticks.
         """
-        t = machine.Timer(id=1, period=8000000)
+        self._phase = 0
+        t = self._timer
         t.start()
         self._subtick(1)
         wasp.system.keep_awake()
 
-        while t.time() < 41666:
-            pass
+        while self._phase < 1:
+            machine.idle()
         self._subtick(1)
 
-        while t.time() < 83332:
-            pass
+        while self._phase < 2:
+            machine.idle()
         self._subtick(1)
 
         t.stop()
-        del t
+
+    def _wake(self, t):
+        self._phase += 1
 
     @property
     def debug(self):
@@ -290,5 +468,5 @@ class HeartApp:
     @debug.setter
     def debug(self, value):
         self._debug = value
-        if value and self._hrdata:
+        if value and self._hrdata != None:
             self._hrdata.enable_debug()